@@ -1,144 +1,204 @@
 import pandas as pd
 import os
+import json
+import hashlib
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 import string
+import re
 import snowballstemmer
 import warnings
+from functools import lru_cache
+from multiprocessing import Pool
+from scipy.sparse import csr_matrix
+from scipy.special import logsumexp
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
 def compute_metrics(confusion_matrix):
-    metrics = {}
-    for category, values in confusion_matrix.items():
-        TP = values['TP']
-        FP = values['FP']
-        TN = values['TN']
-        FN = values['FN']
+    TP, FP, TN, FN = (np.array([values[key] for values in confusion_matrix.values()],
+                               dtype=float)
+                      for key in ('TP', 'FP', 'TN', 'FN'))
+
+    accuracy = safe_divide(TP + TN, TP + FP + TN + FN)
+    precision = safe_divide(TP, TP + FP)
+    recall = safe_divide(TP, TP + FN)
+    f1_score = safe_divide(2 * precision * recall, precision + recall)
 
-        accuracy = (TP + TN) / (TP + FP + TN +
-                                FN) if (TP + FP + TN + FN) > 0 else 0
-        precision = TP / (TP + FP) if (TP + FP) > 0 else 0
-        recall = TP / (TP + FN) if (TP + FN) > 0 else 0
-        f1_score = 2 * (precision * recall) / (precision +
-                                               recall) if (precision + recall) > 0 else 0
+    values = zip(accuracy.tolist(), precision.tolist(),
+                 recall.tolist(), f1_score.tolist())
+    return {category: {'Accuracy': acc, 'Precision': prec, 'Recall': rec, 'F1-Score': f1}
+            for category, (acc, prec, rec, f1) in zip(confusion_matrix, values)}
 
-        metrics[category] = {
-            'Accuracy': accuracy,
-            'Precision': precision,
-            'Recall': recall,
-            'F1-Score': f1_score
-        }
 
-    return metrics
+def safe_divide(numerator, denominator):
+    return np.divide(numerator, denominator,
+                     out=np.zeros_like(numerator, dtype=float), where=denominator > 0)
 
 
 def compute_confusion_matrix(y_true, y_pred, categories):
-    cm = {category: {'TP': 0, 'FP': 0, 'TN': 0, 'FN': 0}
-          for category in categories}
+    # Labels outside categories share the extra last row and column, so they
+    # only count as negatives.
+    matrix = label_confusion_matrix(y_true, y_pred, categories, allow_unknown=True)
+    n_categories = len(categories)
 
-    for true, pred in zip(y_true, y_pred):
-        for category in categories:
-            if true == category and pred == category:
-                cm[category]['TP'] += 1
-            elif true != category and pred == category:
-                cm[category]['FP'] += 1
-            elif true == category and pred != category:
-                cm[category]['FN'] += 1
-            elif true != category and pred != category:
-                cm[category]['TN'] += 1
+    TP = np.diag(matrix)[:n_categories]
+    FP = matrix[:, :n_categories].sum(axis=0) - TP
+    FN = matrix[:n_categories, :].sum(axis=1) - TP
+    TN = matrix.sum() - TP - FP - FN
 
-    return cm
+    values = zip(TP.tolist(), FP.tolist(), TN.tolist(), FN.tolist())
+    return {category: {'TP': tp, 'FP': fp, 'TN': tn, 'FN': fn}
+            for category, (tp, fp, tn, fn) in zip(categories, values)}
 
 
 class Tokenizer:
     def __init__(self, filter, sanitizer):
+        # filter is either a predicate applied to every word of text.split()
+        # or a compiled regex whose matches are the words to keep.
         self.filter = filter
         self.sanitizer = sanitizer
+        if filter is identity_filter and sanitizer is identity:
+            # Nothing to filter or sanitize, skip the per-word calls.
+            self.apply = str.split
 
     def apply(self, text):
+        if isinstance(self.filter, re.Pattern):
+            # \w also matches numeric symbols such as '²' or '½', which are
+            # not letters, so matches are still checked with isalpha.
+            return [self.sanitizer(word) for word in self.filter.findall(text)
+                    if word.isalpha()]
         return [self.sanitizer(word) for word in text.split() if self.filter(word)]
 
 
 class NaiveBayesClassifier:
-    def __init__(self, tokenizer):
-        self.vocab = set()
+    def __init__(self, tokenizer, n_jobs=None, min_df=2):
+        self.vocab = {}
         self.tokenizer = tokenizer
-        self.class_priors = {}
-        self.word_counts = {}
-        self.class_word_counts = {}
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.min_df = min_df
+        self.classes_ = np.array([])
+        self.class_priors = np.array([])
+        self.class_totals = np.array([])
+        self.class_word_counts = np.zeros((0, 0), dtype=np.int32)
+        self.log_prior = np.array([])
+        self.log_prob = np.zeros((0, 0), dtype=np.float32)
 
     def fit(self, X, y):
-        for i in range(len(X)):
-            label = y.iloc[i]
-
-            words = self.tokenizer.apply(X.iloc[i])
-            self.vocab.update(words)
-            if label not in self.class_word_counts:
-                self.class_word_counts[label] = {}
-                self.class_word_counts[label]['__total__'] = 0
-            self.class_word_counts[label]['__total__'] += len(words)
+        # Iterating plain arrays avoids pandas' per-element boxing.
+        texts = np.asarray(X)
+        labels = np.asarray(y)
+        documents = self._tokenize_all(texts)
 
+        self.vocab = {}
+        for words in documents:
             for word in words:
-                if word not in self.class_word_counts[label]:
-                    self.class_word_counts[label][word] = 0
-                self.class_word_counts[label][word] += 1
-
-        total_documents = len(y)
-        self.class_priors = {
-            label: count['__total__'] / total_documents for label, count in self.class_word_counts.items()}
+                self.vocab.setdefault(word, len(self.vocab))
+        document_term = self._documents_to_csr(documents)
+
+        self.classes_, document_class = np.unique(labels, return_inverse=True)
+        class_word_counts = np.zeros((len(self.classes_), len(self.vocab)),
+                                     dtype=np.int32)
+        for i in range(len(self.classes_)):
+            class_word_counts[i] = document_term[document_class == i].sum(axis=0)
+        self.class_totals = class_word_counts.sum(axis=1)
+
+        total_documents = len(labels)
+        self.class_priors = self.class_totals / total_documents
+
+        # A class whose documents have no words keeps a posterior of 0, as
+        # before, without np.log warning about log(0).
+        self.log_prior = np.log(self.class_priors, where=self.class_priors > 0,
+                                out=np.full_like(self.class_priors, -np.inf))
+        log_prob = np.log(
+            (class_word_counts + 1).astype(np.float32) /
+            (self.class_totals[:, None] + len(self.vocab)).astype(np.float32))
+
+        # Pruning only drops columns, totals and priors keep every word.
+        keep = self._prune_vocab(document_term)
+        self.class_word_counts = class_word_counts[:, keep]
+        self.log_prob = log_prob[:, keep]
+
+    def save(self, path, fingerprint=''):
+        # classes_ keeps its dtype, object arrays of labels are pickled.
+        np.savez_compressed(path + '.npz', fingerprint=fingerprint, classes=self.classes_,
+                            class_priors=self.class_priors, class_totals=self.class_totals,
+                            class_word_counts=self.class_word_counts,
+                            log_prior=self.log_prior, log_prob=self.log_prob)
+        with open(path + '.json', 'w', encoding='utf-8') as file:
+            json.dump(self.vocab, file, ensure_ascii=False)
+
+    @staticmethod
+    def saved_fingerprint(path):
+        with np.load(path + '.npz') as arrays:
+            return str(arrays['fingerprint'])
+
+    @classmethod
+    def load(cls, path, tokenizer):
+        classifier = cls(tokenizer)
+        with np.load(path + '.npz', allow_pickle=True) as arrays:
+            classifier.classes_ = arrays['classes']
+            classifier.class_priors = arrays['class_priors']
+            classifier.class_totals = arrays['class_totals']
+            classifier.class_word_counts = arrays['class_word_counts']
+            classifier.log_prior = arrays['log_prior']
+            classifier.log_prob = arrays['log_prob']
+        with open(path + '.json', encoding='utf-8') as file:
+            classifier.vocab = json.load(file)
+        return classifier
 
     def predict(self, X):
-        predictions = []
-        for text in X:
-            posteriors = self._calculate_posteriors(text)
-            predictions.append(max(posteriors, key=posteriors.get))
-        return predictions
-
-    def classify(self, X, y, umbral, category):
-        TP = 0
-        FP = 0
-        FN = 0
-        TN = 0
-        for index in range(len(X)):
-            posteriors = self._calculate_posteriors(X.iloc[index])
-            cat_prob = posteriors[category]
-            total_sum = sum(posteriors.values())
-            if cat_prob/total_sum > umbral:
-                if y.iloc[index] == category:
-                    TP += 1
-                else:
-                    FP += 1
-            else:
-                if y.iloc[index] == category:
-                    FN += 1
-                else:
-                    TN += 1
-        return TP, FP, FN, TN
-
-    def _tokenize(self, text):
-        return text.lower().split()
-
-    def _calculate_posteriors(self, text):
-
-        words = self.tokenizer.apply(text)
-        posteriors = {}
-
-        for label in self.class_priors:
-            prior = self.class_priors[label]
-            likelihood = 1.0
-
-            for word in words:
-                word_count = self.class_word_counts[label].get(word, 0)
-                total_words = self.class_word_counts[label]['__total__']
-                likelihood *= (word_count + 1) / \
-                    (total_words + len(self.vocab))
-
-            posteriors[label] = prior * likelihood
-
-        return posteriors
+        scores = self._joint_log_likelihood(X)
+        return self.classes_[scores.argmax(axis=1)].tolist()
+
+    def predict_proba(self, X):
+        scores = self._joint_log_likelihood(X)
+        return np.exp(scores - logsumexp(scores, axis=1, keepdims=True))
+
+    def _joint_log_likelihood(self, X):
+        # Same dtype as log_prob, so the product stays in float32.
+        document_term = self._texts_to_csr(np.asarray(X)).astype(self.log_prob.dtype)
+        return np.asarray(document_term @ self.log_prob.T) + self.log_prior
+
+    def _prune_vocab(self, document_term):
+        # Words found in fewer than min_df training documents are dropped from
+        # vocab, the returned mask selects the columns that are kept.
+        document_term.sum_duplicates()
+        document_frequency = np.bincount(document_term.indices,
+                                         minlength=len(self.vocab))
+        keep = document_frequency >= self.min_df
+
+        new_ids = np.cumsum(keep) - 1
+        self.vocab = {word: int(new_ids[i])
+                      for word, i in self.vocab.items() if keep[i]}
+        return keep
+
+    def _tokenize_all(self, texts):
+        if self.n_jobs == 1:
+            return [self.tokenizer.apply(text) for text in texts]
+        # Workers receive the pickled Tokenizer, so its filter and sanitizer
+        # must be module-level functions, builtins or compiled patterns.
+        # imap reads the texts array directly, without first copying it into
+        # a list.
+        with Pool(self.n_jobs) as pool:
+            return list(pool.imap(self.tokenizer.apply, texts, chunksize=256))
+
+    def _texts_to_csr(self, texts):
+        return self._documents_to_csr([self.tokenizer.apply(text) for text in texts])
+
+    def _documents_to_csr(self, documents):
+        indptr = [0]
+        indices = []
+        for words in documents:
+            indices.extend(self.vocab[word]
+                           for word in words if word in self.vocab)
+            indptr.append(len(indices))
+
+        data = np.ones(len(indices), dtype=np.int32)
+        return csr_matrix((data, indices, indptr),
+                          shape=(len(documents), len(self.vocab)), dtype=np.int32)
 
 
 def read_input(path='data/Noticias_argentinas'):
@@ -161,6 +221,39 @@ def read_input(path='data/Noticias_argentinas'):
     return df
 
 
+def fit_fingerprint(tokenizer, x_train, y_train):
+    # Hashing the whole module covers the tokenizer helpers, the stemmer and
+    # the classifier, any edit to them trains a new model.
+    with open(__file__, 'rb') as file:
+        digest = hashlib.md5(file.read())
+    for step in (tokenizer.filter, tokenizer.sanitizer):
+        digest.update(getattr(step, '__qualname__', repr(step)).encode())
+    digest.update(pd.util.hash_pandas_object(x_train).to_numpy().tobytes())
+    digest.update(pd.util.hash_pandas_object(y_train).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def fit_classifier(tokenizer, x_train, y_train, path='data/Noticias_argentinas'):
+
+    # A single cache file is overwritten whenever the fingerprint changes.
+    model_path = path + '_nb'
+    fingerprint = fit_fingerprint(tokenizer, x_train, y_train)
+
+    if (os.path.exists(model_path + '.npz') and
+            NaiveBayesClassifier.saved_fingerprint(model_path) == fingerprint):
+
+        nb_classifier = NaiveBayesClassifier.load(model_path, tokenizer)
+        print("Loaded classifier from cache.")
+    else:
+
+        nb_classifier = NaiveBayesClassifier(tokenizer)
+        nb_classifier.fit(x_train, y_train)
+        nb_classifier.save(model_path, fingerprint)
+        print("Trained classifier and saved it to cache.")
+
+    return nb_classifier
+
+
 def no_category_filter(df):
     # df.loc[df["categoria"] == "Destacadas",
     #        "categoria"] = "Noticias destacadas"
@@ -173,30 +266,18 @@ def no_category_filter(df):
 
 
 def train_test_split(df, test_size=0.3, random_state=None, stratify_column='categoria'):
-    if random_state:
-        np.random.seed(random_state)
-
-    train_set = pd.DataFrame(columns=df.columns)
-    test_set = pd.DataFrame(columns=df.columns)
+    # Rows without a value in stratify_column belong to no category and are
+    # left out of both sets.
+    df = df[df[stratify_column].notna()]
+    shuffled = df.sample(frac=1, random_state=random_state)
 
-    for category in df[stratify_column].unique():
-        category_subset = df[df[stratify_column] == category]
-        category_subset = category_subset.sample(
-            frac=1)
-        split_idx = int(len(category_subset) * (1 - test_size))
-        train_subset = category_subset[:split_idx]
-        test_subset = category_subset[split_idx:]
+    groups = shuffled.groupby(stratify_column)
+    ranks = groups.cumcount()
+    sizes = groups[stratify_column].transform('size')
+    is_train = ranks < (sizes * (1 - test_size)).astype(int)
 
-        train_subset = train_subset.dropna(how='all', axis=0)
-        test_subset = test_subset.dropna(how='all', axis=0)
-
-        if not train_subset.empty:
-            train_set = pd.concat([train_set, train_subset], ignore_index=True)
-        if not test_subset.empty:
-            test_set = pd.concat([test_set, test_subset], ignore_index=True)
-
-    train_set = train_set.sample(frac=1).reset_index(drop=True)
-    test_set = test_set.sample(frac=1).reset_index(drop=True)
+    train_set = shuffled[is_train].reset_index(drop=True)
+    test_set = shuffled[~is_train].reset_index(drop=True)
 
     return train_set, test_set
 
@@ -251,15 +332,26 @@ def plot_confusion_matrix(title, true_positive, false_negative, false_positive,
     plt.show()
 
 
-def macroaverage_values_matrix(y_test, y_pred, categories):
-    matrix_size = len(categories)
-    confusion_matrix = np.zeros((matrix_size, matrix_size), dtype=int)
-    category_to_index = {category: i for i, category in enumerate(categories)}
+def label_confusion_matrix(y_true, y_pred, categories, allow_unknown=False):
+    n_categories = len(categories)
+    labels, codes = np.unique(
+        np.concatenate([np.asarray(categories), np.asarray(y_true), np.asarray(y_pred)]),
+        return_inverse=True)
+
+    # np.unique sorts the labels, map its codes back to the order of categories.
+    # Labels outside categories get the extra last index when allow_unknown.
+    label_to_index = np.full(len(labels), n_categories if allow_unknown else -1)
+    label_to_index[codes[:n_categories]] = np.arange(n_categories)
+    true_ix, pred_ix = np.split(label_to_index[codes[n_categories:]], [len(y_true)])
+    if (true_ix < 0).any() or (pred_ix < 0).any():
+        raise ValueError("y_true and y_pred must only contain labels from categories")
+
+    size = n_categories + 1 if allow_unknown else n_categories
+    return np.bincount(true_ix * size + pred_ix, minlength=size ** 2).reshape(size, size)
 
-    for true_label, pred_label in zip(y_test, y_pred):
-        true_index = category_to_index[true_label]
-        pred_index = category_to_index[pred_label]
-        confusion_matrix[true_index, pred_index] += 1
+
+def macroaverage_values_matrix(y_test, y_pred, categories):
+    confusion_matrix = label_confusion_matrix(y_test, y_pred, categories)
 
     precision_per_class = []
     recall_per_class = []
@@ -323,17 +415,27 @@ def complex_filter(word):
     return remove_short_words(word) and remove_non_alpha(word)
 
 
+# Whitespace-delimited words of four or more letters or numeric symbols.
+# Together with the isalpha check in Tokenizer.apply it keeps the same words
+# as complex_filter.
+COMPLEX_PATTERN = re.compile(r'(?<!\S)[^\W\d_]{4,}(?!\S)')
+
+
 def to_lower(word):
     return word.lower()
 
 
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+
 def remove_punctuation(word):
-    return word.translate(str.maketrans('', '', string.punctuation))
+    return word.translate(PUNCTUATION_TABLE)
 
 
 stemmer = snowballstemmer.stemmer('spanish')
 
 
+@lru_cache(maxsize=200_000)
 def stemming_es(palabra):
     return stemmer.stemWord(palabra)
 
@@ -354,24 +456,12 @@ def custom_sanitizer(word):
     return stemming_es(to_lower(remove_punctuation(word)))
 
 
-def custom_filter(word):
-    return True
-
-
 def show_matrix(y_test, y_pred, categories):
 
-    matrix_size = len(categories)
-    confusion_matrix = np.zeros((matrix_size, matrix_size), dtype=int)
-
-    category_to_index = {category: i for i, category in enumerate(categories)}
-
-    for true_label, pred_label in zip(y_test, y_pred):
-        true_index = category_to_index[true_label]
-        pred_index = category_to_index[pred_label]
-        confusion_matrix[true_index, pred_index] += 1
+    confusion_matrix = label_confusion_matrix(y_test, y_pred, categories)
 
     confusion_matrix_percentage = confusion_matrix.astype(
-        float) / confusion_matrix.sum(axis=1)[:, np.newaxis] * 100
+        float) / confusion_matrix.sum(axis=1, keepdims=True) * 100
 
     sns.heatmap(confusion_matrix_percentage, annot=True, fmt=".2f", cmap="Blues",
                 xticklabels=categories, yticklabels=categories, vmax=100)
@@ -383,16 +473,6 @@ def show_matrix(y_test, y_pred, categories):
     plt.yticks(rotation=0)
     plt.show()
 
-    matrix_size = len(categories)
-    confusion_matrix = np.zeros((matrix_size, matrix_size), dtype=int)
-
-    category_to_index = {category: i for i, category in enumerate(categories)}
-
-    for true_label, pred_label in zip(y_test, y_pred):
-        true_index = category_to_index[true_label]
-        pred_index = category_to_index[pred_label]
-        confusion_matrix[true_index, pred_index] += 1
-
     sns.heatmap(confusion_matrix, annot=True, fmt="d", cmap="Blues",
                 xticklabels=categories, yticklabels=categories)
 
@@ -411,20 +491,24 @@ def roc(x_test, y_test, categories, nb_classifier):
     plt.plot([0, 1], [0, 1], linestyle='--', color='gray',
              label='clasificación aleatoria')
 
-    for category in categories:
-        TP_percentages = []
-        FP_percentages = []
+    class_ix = {label: i for i, label in enumerate(nb_classifier.classes_)}
+    category_ix = [class_ix[category] for category in categories]
+    probabilities = nb_classifier.predict_proba(x_test)[:, category_ix]
 
-        for threshold in thresholds:
-            TP, FP, FN, TN = nb_classifier.classify(
-                x_test, y_test, threshold, category)
-            TP_percentage = TP / (TP + FN)
-            FP_percentage = FP / (FP + TN)
+    # (documents, categories, thresholds)
+    predicted = probabilities[:, :, None] > thresholds
+    actual = (np.asarray(y_test)[:, None] == np.asarray(categories))[:, :, None]
 
-            TP_percentages.append(TP_percentage)
-            FP_percentages.append(FP_percentage)
+    TP = (predicted & actual).sum(axis=0)
+    FP = (predicted & ~actual).sum(axis=0)
+    FN = (~predicted & actual).sum(axis=0)
+    TN = (~predicted & ~actual).sum(axis=0)
+    TP_percentages = TP / (TP + FN)
+    FP_percentages = FP / (FP + TN)
 
-        plt.plot(FP_percentages, TP_percentages,
+    for category, TP_percentage, FP_percentage in zip(categories, TP_percentages,
+                                                      FP_percentages):
+        plt.plot(FP_percentage, TP_percentage,
                  marker='o', linestyle='-', label=category)
 
     plt.xlabel('Tasa de Falsos Positivos')
@@ -443,9 +527,10 @@ def main():
     x_train, y_train = split_x_y(train_set)
     x_test, y_test = split_x_y(test_set)
 
-    tokenizer = Tokenizer(complex_filter, complex_sanitize)
-    nb_classifier = NaiveBayesClassifier(tokenizer)
-    nb_classifier.fit(x_train, y_train)
+    # complex_sanitize only lowercases the purely alphabetic words that
+    # COMPLEX_PATTERN keeps.
+    tokenizer = Tokenizer(COMPLEX_PATTERN, str.lower)
+    nb_classifier = fit_classifier(tokenizer, x_train, y_train)
 
     categories = extract_categories(train_set)
     y_pred = nb_classifier.predict(x_test)
@@ -477,8 +562,7 @@ def no_filters():
     print(len(x_test))
 
     tokenizer = Tokenizer(identity_filter, identity)
-    nb_classifier = NaiveBayesClassifier(tokenizer)
-    nb_classifier.fit(x_train, y_train)
+    nb_classifier = fit_classifier(tokenizer, x_train, y_train)
 
     categories = extract_categories(train_set)
 